@@ -1,34 +1,21 @@
+import asyncio
 import logging
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler, filters
 from telegram.constants import ParseMode
+from sqlalchemy import func
 
 logger = logging.getLogger(__name__)
 
+# Files shown per /myfiles page
+FILES_PER_PAGE = 20
 
-def format_file_size(size_bytes):
-    """Format file size in human readable format"""
-    if size_bytes is None:
-        return "Unknown size"
-    
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if size_bytes < 1024.0:
-            return f"{size_bytes:.1f} {unit}"
-        size_bytes /= 1024.0
-    return f"{size_bytes:.1f} TB"
-
+# Byte thresholds for human readable sizes, largest first
+SIZE_UNITS = ((1099511627776, "TB"), (1073741824, "GB"), (1048576, "MB"), (1024, "KB"))
 
-def format_date(date_obj):
-    """Format date in a user-friendly way"""
-    if date_obj is None:
-        return "Unknown date"
-    return date_obj.strftime("%B %d, %Y at %I:%M %p")
 
-
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /start command"""
-    welcome_text = """
+WELCOME_TEXT = """
 🌟 <b>Welcome to @SAN_mediabot!</b> 🌟
 
 🚀 <i>Your personal cloud storage assistant</i>
@@ -49,28 +36,8 @@ Simply send me any file and I'll store it safely for you!
 
 <i>Built with ❤️ for premium experience</i>
 """
-    
-    keyboard = [
-        [
-            InlineKeyboardButton("📂 My Files", callback_data="my_files"),
-            InlineKeyboardButton("❓ Help", callback_data="help")
-        ],
-        [
-            InlineKeyboardButton("🚀 Upload First File", callback_data="upload_guide")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        welcome_text,
-        parse_mode=ParseMode.HTML,
-        reply_markup=reply_markup
-    )
 
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /help command"""
-    help_text = """
+HELP_TEXT = """
 🔧 <b>How to Use @SAN_mediabot</b> 🔧
 
 <b>📤 Uploading Files:</b>
@@ -96,7 +63,72 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 <b>🆘 Need Support?</b>
 For any queries contact @takezo_5
 """
+
+
+EMPTY_FILES_TEXT = """
+📂 <b>Your File Storage is Empty</b>
+
+🌟 <i>Ready to get started?</i>
+
+Upload your first file by sending any document, image, video, or audio file to this chat!
+
+<b>✨ Pro Features:</b>
+• Unlimited file types supported
+• Instant download access
+• Secure cloud storage
+• Smart file organization
+"""
+
+FILES_HEADER_TEMPLATE = """
+📂 <b>Your Premium File Storage</b>
+
+🗂️ <i>Total Files: {total_files}</i>
+📊 <i>Storage Used: {total_size}</i>
+
+💎 <b>Select any file to download:</b>
+"""
+
+
+def format_file_size(size_bytes):
+    """Format file size in human readable format"""
+    if size_bytes is None:
+        return "Unknown size"
     
+    for factor, unit in SIZE_UNITS:
+        if size_bytes >= factor:
+            return f"{size_bytes / factor:.1f} {unit}"
+    return f"{size_bytes:.1f} B"
+
+
+def format_date(date_obj):
+    """Format date in a user-friendly way"""
+    if date_obj is None:
+        return "Unknown date"
+    return date_obj.strftime("%B %d, %Y at %I:%M %p")
+
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /start command"""
+    keyboard = [
+        [
+            InlineKeyboardButton("📂 My Files", callback_data="my_files"),
+            InlineKeyboardButton("❓ Help", callback_data="help")
+        ],
+        [
+            InlineKeyboardButton("🚀 Upload First File", callback_data="upload_guide")
+        ]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await update.message.reply_text(
+        WELCOME_TEXT,
+        parse_mode=ParseMode.HTML,
+        reply_markup=reply_markup
+    )
+
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /help command"""
     keyboard = [
         [
             InlineKeyboardButton("📂 View My Files", callback_data="my_files"),
@@ -106,7 +138,7 @@ For any queries contact @takezo_5
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await update.message.reply_text(
-        help_text,
+        HELP_TEXT,
         parse_mode=ParseMode.HTML,
         reply_markup=reply_markup
     )
@@ -116,6 +148,7 @@ async def handle_file_upload(update: Update, context: ContextTypes.DEFAULT_TYPE,
     """Handle file uploads"""
     try:
         from models import FileMetadata
+        from cache import invalidate_file_list
         
         user_id = update.effective_user.id
         message = update.message
@@ -154,45 +187,51 @@ async def handle_file_upload(update: Update, context: ContextTypes.DEFAULT_TYPE,
             await message.reply_text("❌ Sorry, I couldn't process this file type.")
             return
         
-        # Save to database
-        with flask_app.app_context():
-            # Check if file already exists for this user
-            existing_file = FileMetadata.query.filter_by(
-                user_id=user_id, 
-                file_id=file_obj.file_id
-            ).first()
+        def save_metadata():
+            """Store the file record; runs in a worker thread"""
+            with flask_app.app_context():
+                # Check if file already exists for this user
+                existing_file = FileMetadata.query.filter_by(
+                    user_id=user_id, 
+                    file_id=file_obj.file_id
+                ).first()
             
-            if existing_file:
-                # File already exists, return the existing record
-                file_metadata = existing_file
-                success_message = "File already exists in your storage!"
-            else:
-                # Create new file metadata record with proper exception handling
-                try:
-                    file_metadata = FileMetadata(
-                        user_id=user_id,
-                        file_id=file_obj.file_id,
-                        filename=filename,
-                        file_size=getattr(file_obj, 'file_size', None),
-                        mime_type=detected_mime_type or getattr(file_obj, 'mime_type', None)
-                    )
-                    db.session.add(file_metadata)
-                    db.session.commit()
-                    success_message = "File Uploaded Successfully!"
-                except Exception as e:
-                    db.session.rollback()
-                    # Try to get existing file if unique constraint failed
-                    existing_file = FileMetadata.query.filter_by(file_id=file_obj.file_id).first()
-                    if existing_file:
-                        file_metadata = existing_file
-                        success_message = "File already exists in your storage!"
-                    else:
-                        raise e
+                if existing_file:
+                    # File already exists, return the existing record
+                    file_metadata = existing_file
+                    success_message = "File already exists in your storage!"
+                else:
+                    # Create new file metadata record with proper exception handling
+                    try:
+                        file_metadata = FileMetadata(
+                            user_id=user_id,
+                            file_id=file_obj.file_id,
+                            filename=filename,
+                            file_size=getattr(file_obj, 'file_size', None),
+                            mime_type=detected_mime_type or getattr(file_obj, 'mime_type', None)
+                        )
+                        db.session.add(file_metadata)
+                        db.session.commit()
+                        invalidate_file_list(user_id)
+                        success_message = "File Uploaded Successfully!"
+                    except Exception as e:
+                        db.session.rollback()
+                        # Try to get existing file if unique constraint failed
+                        existing_file = FileMetadata.query.filter_by(file_id=file_obj.file_id).first()
+                        if existing_file:
+                            file_metadata = existing_file
+                            success_message = "File already exists in your storage!"
+                        else:
+                            raise e
             
-            # Get the file metadata for response
-            file_size = file_metadata.file_size
-            mime_type = file_metadata.mime_type or getattr(file_obj, 'mime_type', None)
-            upload_date = file_metadata.upload_date
+                # Get the file metadata for response
+                file_size = file_metadata.file_size
+                mime_type = file_metadata.mime_type or getattr(file_obj, 'mime_type', None)
+                upload_date = file_metadata.upload_date
+                return success_message, file_size, mime_type, upload_date
+        
+        # Save to database off the event loop so other updates keep flowing
+        success_message, file_size, mime_type, upload_date = await asyncio.to_thread(save_metadata)
         
         # Success response with premium styling
         success_text = f"""
@@ -238,69 +277,97 @@ async def handle_file_upload(update: Update, context: ContextTypes.DEFAULT_TYPE,
         )
 
 
-async def my_files_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db, flask_app):
-    """Handle /myfiles command"""
+async def my_files_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db, flask_app, page=1):
+    """Handle /myfiles command and its later pages"""
     try:
         from models import FileMetadata
+        from cache import get_file_list, set_file_list, get_file_totals, set_file_totals
         
         user_id = update.effective_user.id
         
-        # Query user's files
-        with flask_app.app_context():
-            files = FileMetadata.query.filter_by(user_id=user_id).order_by(FileMetadata.upload_date.desc()).all()
+        def load_listing():
+            """Serve the file list from cache, falling back to the database; runs in a worker thread"""
+            # Only the first page is cached; later pages are rarely requested
+            listing = get_file_list(user_id) if page == 1 else None
+            if listing is None:
+                with flask_app.app_context():
+                    # Totals are cached on their own so paging past page 1 runs only the page query;
+                    # on a miss the aggregate reads every one of the user's rows, as file_size is not indexed
+                    totals = get_file_totals(user_id)
+                    if totals is None:
+                        total_files, total_size = db.session.query(
+                            func.count(FileMetadata.id),
+                            func.coalesce(func.sum(FileMetadata.file_size), 0)
+                        ).filter(FileMetadata.user_id == user_id).one()
+                        totals = (total_files, int(total_size))
+                        set_file_totals(user_id, *totals)
+                    total_files, total_size = totals
+                
+                    # Fetch only the requested page; the (user_id, upload_date) index lets Postgres stop early
+                    page_files = (
+                        FileMetadata.query.filter_by(user_id=user_id)
+                        .order_by(FileMetadata.upload_date.desc())
+                        .offset((page - 1) * FILES_PER_PAGE)
+                        .limit(FILES_PER_PAGE)
+                        .all()
+                    )
+                    listing = {
+                        "total_files": total_files,
+                        "total_size": total_size,
+                        "files": [
+                            {
+                                "id": file.id,
+                                "filename": file.filename,
+                                "file_size": file.file_size,
+                                "mime_type": file.mime_type
+                            }
+                            for file in page_files
+                        ]
+                    }
+                if page == 1:
+                    set_file_list(user_id, listing)
+            return listing
         
-        if not files:
-            empty_text = """
-📂 <b>Your File Storage is Empty</b>
-
-🌟 <i>Ready to get started?</i>
-
-Upload your first file by sending any document, image, video, or audio file to this chat!
-
-<b>✨ Pro Features:</b>
-• Unlimited file types supported
-• Instant download access
-• Secure cloud storage
-• Smart file organization
-"""
+        listing = await asyncio.to_thread(load_listing)
+        
+        files = listing["files"]
+        
+        if not listing["total_files"]:
             keyboard = [
                 [InlineKeyboardButton("📤 Upload Your First File", callback_data="upload_guide")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             await update.effective_message.reply_text(
-                empty_text,
+                EMPTY_FILES_TEXT,
                 parse_mode=ParseMode.HTML,
                 reply_markup=reply_markup
             )
             return
         
         # Create file list with premium styling
-        header_text = f"""
-📂 <b>Your Premium File Storage</b>
-
-🗂️ <i>Total Files: {len(files)}</i>
-📊 <i>Storage Used: {format_file_size(sum(f.file_size or 0 for f in files))}</i>
-
-💎 <b>Select any file to download:</b>
-"""
+        header_text = FILES_HEADER_TEMPLATE.format(
+            total_files=listing["total_files"],
+            total_size=format_file_size(listing["total_size"])
+        )
         
-        # Create inline keyboard with file buttons (max 20 files per page)
+        # Create inline keyboard with file buttons (one page of files)
         keyboard = []
-        for i, file in enumerate(files[:20]):
+        for i, file in enumerate(files):
             file_emoji = "📄"
-            if file.mime_type:
-                if file.mime_type.startswith('image/'):
+            mime_type = file["mime_type"]
+            if mime_type:
+                if mime_type.startswith('image/'):
                     file_emoji = "🖼️"
-                elif file.mime_type.startswith('video/'):
+                elif mime_type.startswith('video/'):
                     file_emoji = "🎥"
-                elif file.mime_type.startswith('audio/'):
+                elif mime_type.startswith('audio/'):
                     file_emoji = "🎵"
-                elif 'pdf' in file.mime_type:
+                elif 'pdf' in mime_type:
                     file_emoji = "📋"
             
             # Truncate long filenames for button display
-            display_name = file.filename
+            display_name = file["filename"]
             if len(display_name) > 25:
                 display_name = display_name[:22] + "..."
             
@@ -308,15 +375,18 @@ Upload your first file by sending any document, image, video, or audio file to t
             keyboard.append([
                 InlineKeyboardButton(
                     button_text,
-                    callback_data=f"dl_{file.id}"
+                    callback_data=f"dl_{file['id']}"
                 )
             ])
         
         # Add navigation and utility buttons
-        if len(files) > 20:
-            keyboard.append([
-                InlineKeyboardButton("➡️ Show More Files", callback_data="files_page_2")
-            ])
+        navigation = []
+        if page > 1:
+            navigation.append(InlineKeyboardButton("⬅️ Previous Files", callback_data=f"files_page_{page - 1}"))
+        if listing["total_files"] > page * FILES_PER_PAGE:
+            navigation.append(InlineKeyboardButton("➡️ Show More Files", callback_data=f"files_page_{page + 1}"))
+        if navigation:
+            keyboard.append(navigation)
         
         keyboard.append([
             InlineKeyboardButton("📤 Upload New File", callback_data="upload_guide"),
@@ -347,28 +417,6 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db
     
     try:
         if query.data == "start":
-            welcome_text = """
-🌟 <b>Welcome to @SAN_mediabot!</b> 🌟
-
-🚀 <i>Your personal cloud storage assistant</i>
-
-<b>✨ What I can do for you:</b>
-📁 Store any type of file securely
-📋 Keep track of all your uploads
-💾 Easy file retrieval anytime
-🔍 Smart file management
-
-<b>🎯 Quick Commands:</b>
-/myfiles - 📂 View all your files
-/start - 🏠 Show this welcome message
-/help - ❓ Get detailed help
-
-<b>📤 Getting Started:</b>
-Simply send me any file and I'll store it safely for you!
-
-<i>Built with ❤️ for premium experience</i>
-"""
-            
             keyboard = [
                 [
                     InlineKeyboardButton("📂 My Files", callback_data="my_files"),
@@ -381,38 +429,11 @@ Simply send me any file and I'll store it safely for you!
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             await query.edit_message_text(
-                welcome_text,
+                WELCOME_TEXT,
                 parse_mode=ParseMode.HTML,
                 reply_markup=reply_markup
             )
         elif query.data == "help":
-            help_text = """
-🔧 <b>How to Use @SAN_mediabot</b> 🔧
-
-<b>📤 Uploading Files:</b>
-• Send any file directly to this chat
-• Supported: Documents, Images, Videos, Audio, etc.
-• Files are stored securely with metadata
-
-<b>📁 Managing Files:</b>
-• Use /myfiles to see all your uploaded files
-• Click any file button to download instantly
-• Files are organized by upload date
-
-<b>🔍 File Information:</b>
-• File name and size are preserved
-• Upload timestamp is recorded
-• Easy one-click download access
-
-<b>⚡ Pro Tips:</b>
-• Send multiple files at once
-• Use descriptive filenames for easy identification
-• Your files are private and secure
-
-<b>🆘 Need Support?</b>
-For any queries contact @takezo_5
-"""
-            
             keyboard = [
                 [
                     InlineKeyboardButton("📂 View My Files", callback_data="my_files"),
@@ -422,12 +443,15 @@ For any queries contact @takezo_5
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             await query.edit_message_text(
-                help_text,
+                HELP_TEXT,
                 parse_mode=ParseMode.HTML,
                 reply_markup=reply_markup
             )
         elif query.data == "my_files":
             await my_files_command(update, context, db, flask_app)
+        elif query.data.startswith("files_page_"):
+            page = int(query.data.replace("files_page_", ""))
+            await my_files_command(update, context, db, flask_app, page=page)
         elif query.data == "upload_guide":
             guide_text = """
 📤 <b>How to Upload Files</b>
@@ -466,9 +490,12 @@ For any queries contact @takezo_5
             
             record_id = query.data.replace("dl_", "")
             
-            # Get file metadata by database ID
-            with flask_app.app_context():
-                file_metadata = FileMetadata.query.get(int(record_id))
+            def load_file():
+                """Get file metadata by database ID; runs in a worker thread"""
+                with flask_app.app_context():
+                    return FileMetadata.query.get(int(record_id))
+            
+            file_metadata = await asyncio.to_thread(load_file)
             
             if not file_metadata:
                 await query.edit_message_text("❌ File not found or has been deleted.")
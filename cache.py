@@ -0,0 +1,90 @@
+import os
+import logging
+
+import orjson
+import redis
+
+logger = logging.getLogger(__name__)
+
+# Seconds a user's cached file list stays valid
+FILE_LIST_TTL = 60
+
+# Seconds a user's cached totals stay valid; they only change on upload, which invalidates them
+FILE_TOTALS_TTL = 3600
+
+# Seconds to wait on Redis before falling back to the database
+REDIS_TIMEOUT = 0.2
+
+# Caching is enabled only when a Redis URL is configured
+redis_url = os.environ.get("REDIS_URL")
+redis_client = redis.Redis(
+    connection_pool=redis.ConnectionPool.from_url(
+        redis_url,
+        socket_connect_timeout=REDIS_TIMEOUT,
+        socket_timeout=REDIS_TIMEOUT
+    )
+) if redis_url else None
+
+
+def file_list_key(user_id):
+    """Redis key holding a user's file list"""
+    return f"files:{user_id}"
+
+
+def file_totals_key(user_id):
+    """Redis key holding a user's file count and total size"""
+    return f"files:{user_id}:totals"
+
+
+def get_file_list(user_id):
+    """Return a user's cached file listing, or None on a miss"""
+    if redis_client is None:
+        return None
+    try:
+        cached = redis_client.get(file_list_key(user_id))
+    except redis.RedisError as e:
+        logger.warning(f"Redis get failed: {e}")
+        return None
+    return orjson.loads(cached) if cached else None
+
+
+def set_file_list(user_id, listing):
+    """Cache a user's file listing (totals plus id, filename, size and MIME type per file)"""
+    if redis_client is None:
+        return
+    try:
+        redis_client.setex(file_list_key(user_id), FILE_LIST_TTL, orjson.dumps(listing))
+    except redis.RedisError as e:
+        logger.warning(f"Redis set failed: {e}")
+
+
+def get_file_totals(user_id):
+    """Return a user's cached (file count, total size), or None on a miss"""
+    if redis_client is None:
+        return None
+    try:
+        cached = redis_client.get(file_totals_key(user_id))
+    except redis.RedisError as e:
+        logger.warning(f"Redis get failed: {e}")
+        return None
+    return tuple(orjson.loads(cached)) if cached else None
+
+
+def set_file_totals(user_id, total_files, total_size):
+    """Cache a user's file count and total size"""
+    if redis_client is None:
+        return
+    try:
+        redis_client.setex(file_totals_key(user_id), FILE_TOTALS_TTL, orjson.dumps([total_files, total_size]))
+    except redis.RedisError as e:
+        logger.warning(f"Redis set failed: {e}")
+
+
+def invalidate_file_list(user_id):
+    """Drop a user's cached file list and totals after their files change"""
+    if redis_client is None:
+        return
+    try:
+        redis_client.delete(file_list_key(user_id), file_totals_key(user_id))
+    except redis.RedisError as e:
+        logger.warning(f"Redis delete failed: {e}")
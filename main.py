@@ -1,18 +1,38 @@
 import os
+import re
 import asyncio
 import logging
-from threading import Thread
+from threading import BoundedSemaphore, Thread
 
+import orjson
 from flask import Flask, request
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError, ProgrammingError
 from sqlalchemy.orm import DeclarativeBase
-from telegram.ext import Application
+from telegram.ext import Application, SimpleUpdateProcessor
 from telegram import Update
+from telegram.error import RetryAfter
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Settings read once at import
+BOT_TOKEN = os.environ.get("BOT_TOKEN")
+RENDER = bool(os.environ.get("RENDER"))
+PORT = int(os.environ.get("PORT", 5000))
+RENDER_URL = os.environ.get("RENDER_EXTERNAL_URL")
+
+# Seconds a worker waits on each Telegram call made while booting
+STARTUP_TIMEOUT = 10
+
+# Handlers run at once; the Bot's HTTP pool matches so each can hold a Telegram connection
+CONCURRENT_UPDATES = 32
+
+# Most webhook updates queued or being handled at once; further updates are dropped
+MAX_UPDATES_IN_FLIGHT = 1000
+
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -20,6 +40,15 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Arbitrary Postgres advisory lock key serializing schema setup across workers
+SCHEMA_LOCK_KEY = 4172201
+
+# Webhook slots, taken when an update is accepted and released when its handler finishes
+UPDATES_IN_FLIGHT = BoundedSemaphore(MAX_UPDATES_IN_FLIGHT)
+
+# Matches the quoted connection URL in a "psql '<url>'" style DATABASE_URL
+_PSQL_URL_RE = re.compile(r"'(postgresql://[^']+)'")
+
 
 # Import db from models to avoid circular import
 from models import db
@@ -37,8 +66,7 @@ if not database_url:
 # Clean the database URL if it contains psql command syntax
 if database_url.startswith("psql"):
     # Extract the actual URL from psql command
-    import re
-    match = re.search(r"'(postgresql://[^']+)'", database_url)
+    match = _PSQL_URL_RE.search(database_url)
     if match:
         database_url = match.group(1)
     else:
@@ -47,7 +75,12 @@ if database_url.startswith("psql"):
 
 logger.info(f"Using database URL: {database_url[:30]}...")  # Log first 30 chars for debugging
 app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+# Each gunicorn worker holds its own pool, so Postgres sees workers x (pool_size + max_overflow)
+# connections; the defaults keep two workers within small Neon/Render plan limits
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": int(os.environ.get("SQLA_POOL_SIZE", 5)),
+    "max_overflow": int(os.environ.get("SQLA_MAX_OVERFLOW", 5)),
+    "pool_timeout": int(os.environ.get("SQLA_POOL_TIMEOUT", 5)),
     "pool_recycle": 300,
     "pool_pre_ping": True,
 }
@@ -55,11 +88,34 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 # Initialize the app with the extension
 db.init_app(app)
 
+
+def init_schema():
+    """Create missing tables and indexes, one gunicorn worker at a time"""
+    try:
+        with db.engine.connect() as conn:
+            is_postgres = conn.dialect.name == "postgresql"
+            if is_postgres:
+                # CREATE INDEX CONCURRENTLY can't run inside a transaction
+                conn.execution_options(isolation_level="AUTOCOMMIT")
+                conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+            try:
+                db.metadata.create_all(conn)
+                # create_all() skips indexes on tables that already exist
+                models.file_user_date_index.create(conn, checkfirst=True)
+                conn.commit()
+            finally:
+                if is_postgres:
+                    conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_KEY})
+    except (ProgrammingError, IntegrityError) as e:
+        # Another process won a race the lock couldn't cover; the schema is there either way
+        logger.error(f"Error creating database schema: {e}")
+
+
 # Import models and bot handlers
 with app.app_context():
     import models  # noqa: F401
     from bot_handlers import setup_bot_handlers
-    db.create_all()
+    init_schema()
 
 
 @app.route('/')
@@ -88,43 +144,56 @@ def favicon():
 def debug():
     """Debug endpoint to check environment variables (for troubleshooting)"""
     return {
-        "bot_token_set": bool(os.environ.get("BOT_TOKEN")),
+        "bot_token_set": bool(BOT_TOKEN),
         "database_url_set": bool(os.environ.get("DATABASE_URL")),
         "flask_secret_set": bool(os.environ.get("FLASK_SECRET_KEY")),
-        "render_env": bool(os.environ.get("RENDER")),
-        "port": os.environ.get("PORT", "5000")
+        "render_env": RENDER,
+        "port": PORT
     }
 
 
+def _build_application(webhook=False):
+    """Build the bot Application and register its handlers"""
+    builder = Application.builder().token(BOT_TOKEN)
+    if webhook:
+        # No Updater; updates arrive through the webhook route and are processed concurrently.
+        # Handlers run their database and cache work in threads, so the loop stays free.
+        builder = (
+            builder.updater(None)
+            .connection_pool_size(CONCURRENT_UPDATES)
+            .concurrent_updates(_InFlightUpdateProcessor(CONCURRENT_UPDATES))
+        )
+    application = builder.build()
+    
+    # Registering handlers doesn't touch the database; handlers push an app context only around queries
+    setup_bot_handlers(application, db, app)
+    
+    return application
+
+
+class _InFlightUpdateProcessor(SimpleUpdateProcessor):
+    """Process updates concurrently, freeing a webhook slot once each one is handled"""
+    
+    async def do_process_update(self, update, coroutine):
+        try:
+            await coroutine
+        finally:
+            UPDATES_IN_FLIGHT.release()
+
+
 def run_bot():
     """Run the Telegram bot"""
     try:
-        bot_token = os.environ.get("BOT_TOKEN")
-        if not bot_token:
+        if not BOT_TOKEN:
             logger.error("BOT_TOKEN environment variable is required")
             return
 
-        logger.info(f"Bot token found: {bot_token[:10]}..." if bot_token else "No token")
-        
-        # Create application
-        application = Application.builder().token(bot_token).build()
+        logger.info(f"Bot token found: {BOT_TOKEN[:10]}..." if BOT_TOKEN else "No token")
         
-        # Setup bot handlers
-        with app.app_context():
-            setup_bot_handlers(application, db, app)
+        application = _build_application()
         
-        # Start the bot with proper async handling
+        # Start polling; run_polling manages its own event loop
         logger.info("Starting Telegram bot polling...")
-        import asyncio
-        
-        # Create new event loop for this thread if needed
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        
-        # Start polling
         application.run_polling(drop_pending_updates=True)
         
     except Exception as e:
@@ -135,279 +204,110 @@ def run_bot():
 
 def run_flask():
     """Run the Flask app"""
-    port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=False)
-
-
-async def setup_webhook():
-    """Set up webhook for production deployment"""
-    try:
-        bot_token = os.environ.get("BOT_TOKEN")
-        if not bot_token:
-            logger.error("BOT_TOKEN not found for webhook setup")
-            return None
-            
-        application = Application.builder().token(bot_token).build()
-        
-        with app.app_context():
-            setup_bot_handlers(application, db, app)
-        
-        # Get the webhook URL from environment or construct it
-        webhook_url = os.environ.get("WEBHOOK_URL")
-        if not webhook_url:
-            # Construct from Render service URL
-            service_url = os.environ.get("RENDER_EXTERNAL_URL", "https://your-service.onrender.com")
-            webhook_url = f"{service_url}/webhook/{bot_token}"
-        
-        logger.info(f"Setting webhook URL: {webhook_url}")
-        await application.bot.set_webhook(url=webhook_url)
-        
-        return application
-        
-    except Exception as e:
-        logger.error(f"Error setting up webhook: {e}")
-        return None
+    app.run(host="0.0.0.0", port=PORT, debug=False)
 
 
-if __name__ == "__main__":
-    # Check if we're running on Render (production)
-    if os.environ.get("RENDER"):
-        # On Render, use webhook mode with Flask
-        logger.info("Running on Render - Flask app with webhook mode")
-        
-        # Debug environment variables
-        logger.info(f"RENDER env: {os.environ.get('RENDER')}")
-        logger.info(f"PORT env: {os.environ.get('PORT')}")
-        logger.info(f"BOT_TOKEN set: {bool(os.environ.get('BOT_TOKEN'))}")
-        logger.info(f"DATABASE_URL set: {bool(os.environ.get('DATABASE_URL'))}")
+def setup_render_webhook():
+    """Configure webhook mode for production deployment on Render"""
+    # Debug environment variables
+    logger.info(f"RENDER env: {RENDER}")
+    logger.info(f"PORT env: {PORT}")
+    logger.info(f"BOT_TOKEN set: {bool(BOT_TOKEN)}")
+    logger.info(f"DATABASE_URL set: {bool(os.environ.get('DATABASE_URL'))}")
+    
+    # Set up bot for webhook mode with background processing
+    if BOT_TOKEN:
+        # Run the Application on its own event loop so Flask threads can hand it updates
+        loop = asyncio.new_event_loop()
+        Thread(target=loop.run_forever, name="telegram-bot-loop", daemon=True).start()
+        try:
+            application = _build_application(webhook=True)
+            # initialize() calls getMe, so a bad token or Telegram outage fails here
+            asyncio.run_coroutine_threadsafe(application.initialize(), loop).result(timeout=STARTUP_TIMEOUT)
+            asyncio.run_coroutine_threadsafe(application.start(), loop).result(timeout=STARTUP_TIMEOUT)
+        except Exception as e:
+            # Keep serving health checks even if the bot can't start
+            logger.error(f"Error starting bot application: {e}", exc_info=True)
+            loop.call_soon_threadsafe(loop.stop)
+            return
         
-        # Set up bot for webhook mode with synchronous processing
-        bot_token = os.environ.get("BOT_TOKEN")
-        if bot_token:
-            from telegram import Bot
-            from telegram.ext._utils.types import HandlerCallback
+        # Add webhook endpoint that acknowledges updates immediately
+        @app.route(f'/webhook/{BOT_TOKEN}', methods=['POST'])
+        def webhook():
+            """Handle webhook updates from Telegram - hand off to the Application"""
+            try:
+                json_data = orjson.loads(request.get_data())
+            except orjson.JSONDecodeError:
+                json_data = None
+            if not json_data:
+                logger.error("No JSON data received in webhook")
+                return 'No data', 400
+            if not isinstance(json_data, dict):
+                logger.error("Webhook body is not a JSON object")
+                return 'Invalid update', 400
             
-            # Create a simple Bot instance for synchronous operations
-            bot = Bot(token=bot_token)
+            update = Update.de_json(json_data, application.bot)
+            if not update:
+                logger.error("Failed to parse update from JSON")
+                return 'Invalid update', 400
             
-            # Import required models
-            from models import FileMetadata
+            # Bound updates that are queued or running, not just the queue, which PTB drains at once
+            if not UPDATES_IN_FLIGHT.acquire(blocking=False):
+                # Still acknowledge so Telegram doesn't retry into the backlog
+                logger.error(f"Too many updates in flight, dropping update {update.update_id}")
+                return 'OK', 200
             
-            # Add webhook endpoint with direct synchronous processing
-            @app.route(f'/webhook/{bot_token}', methods=['POST'])
-            def webhook():
-                """Handle webhook updates from Telegram - synchronous processing"""
-                try:
-                    json_data = request.get_json(force=True)
-                    if not json_data:
-                        logger.error("No JSON data received in webhook")
-                        return 'No data', 400
-                    
-                    update = Update.de_json(json_data, bot)
-                    if not update:
-                        logger.error("Failed to parse update from JSON")
-                        return 'Invalid update', 400
-                    
-                    logger.info(f"Processing update: {update.update_id}")
-                    
-                    # Process different types of updates synchronously
-                    with app.app_context():
-                        try:
-                            if update.message and update.message.from_user:
-                                message = update.message
-                                user_id = message.from_user.id
-                                
-                                # Handle commands
-                                if message.text:
-                                    if message.text.startswith('/start'):
-                                        # Send start message synchronously
-                                        import asyncio
-                                        loop = asyncio.new_event_loop()
-                                        asyncio.set_event_loop(loop)
-                                        try:
-                                            loop.run_until_complete(bot.send_message(
-                                                chat_id=user_id,
-                                                text="🎉 Welcome to your Personal File Manager Bot!\n\n"
-                                                     "I can help you store and manage your files securely. Here's what I can do:\n\n"
-                                                     "📤 **Upload Files**: Send me any file and I'll store it safely\n"
-                                                     "📁 **View Files**: Use /myfiles to see all your stored files\n"
-                                                     "❓ **Get Help**: Use /help for more information\n\n"
-                                                     "Ready to get started? Send me a file!"
-                                            ))
-                                        finally:
-                                            loop.close()
-                                    elif message.text.startswith('/help'):
-                                        import asyncio
-                                        loop = asyncio.new_event_loop()
-                                        asyncio.set_event_loop(loop)
-                                        try:
-                                            loop.run_until_complete(bot.send_message(
-                                                chat_id=user_id,
-                                                text="🤖 **File Manager Bot Help**\n\n"
-                                                     "**Available Commands:**\n"
-                                                     "• /start - Welcome message and introduction\n"
-                                                     "• /myfiles - View all your stored files\n"
-                                                     "• /help - Show this help message\n\n"
-                                                     "**How to use:**\n"
-                                                     "1. Send me any file (document, image, video, etc.)\n"
-                                                     "2. I'll store it and give you a confirmation\n"
-                                                     "3. Use /myfiles to see your file collection\n"
-                                                     "4. Click on any file to download it again\n\n"
-                                                     "That's it! Simple and secure file storage at your fingertips! 📁✨"
-                                            ))
-                                        finally:
-                                            loop.close()
-                                    elif message.text.startswith('/myfiles'):
-                                        # Query user's files from database
-                                        files = FileMetadata.query.filter_by(user_id=user_id).order_by(FileMetadata.upload_date.desc()).all()
-                                        
-                                        import asyncio
-                                        loop = asyncio.new_event_loop()
-                                        asyncio.set_event_loop(loop)
-                                        try:
-                                            if not files:
-                                                loop.run_until_complete(bot.send_message(
-                                                    chat_id=user_id,
-                                                    text="📁 Your file storage is empty!\n\nSend me any file to get started. I can store documents, images, videos, and more! 📤"
-                                                ))
-                                            else:
-                                                # Create file list message
-                                                file_list = f"📁 **Your Files** ({len(files)} total)\n\n"
-                                                for i, file in enumerate(files[:10], 1):  # Show first 10 files
-                                                    size_mb = round(file.file_size / (1024 * 1024), 2)
-                                                    file_list += f"{i}. **{file.filename}**\n"
-                                                    file_list += f"   📊 {size_mb} MB • {file.upload_date.strftime('%Y-%m-%d %H:%M')}\n\n"
-                                                
-                                                if len(files) > 10:
-                                                    file_list += f"... and {len(files) - 10} more files"
-                                                
-                                                loop.run_until_complete(bot.send_message(
-                                                    chat_id=user_id,
-                                                    text=file_list,
-                                                    parse_mode='Markdown'
-                                                ))
-                                        finally:
-                                            loop.close()
-                                
-                                # Handle file uploads
-                                elif message.document or message.photo or message.video or message.audio or message.voice:
-                                    # Extract file information
-                                    file_obj = None
-                                    filename = "unknown_file"
-                                    
-                                    if message.document:
-                                        file_obj = message.document
-                                        filename = file_obj.file_name or f"document_{file_obj.file_id[:8]}"
-                                    elif message.photo:
-                                        file_obj = message.photo[-1]  # Get highest resolution
-                                        filename = f"photo_{file_obj.file_id[:8]}.jpg"
-                                    elif message.video:
-                                        file_obj = message.video
-                                        filename = f"video_{file_obj.file_id[:8]}.mp4"
-                                    elif message.audio:
-                                        file_obj = message.audio
-                                        filename = file_obj.file_name or f"audio_{file_obj.file_id[:8]}.mp3"
-                                    elif message.voice:
-                                        file_obj = message.voice
-                                        filename = f"voice_{file_obj.file_id[:8]}.ogg"
-                                    
-                                    if file_obj:
-                                        # Save file metadata to database
-                                        file_metadata = FileMetadata(
-                                            user_id=user_id,
-                                            filename=filename,
-                                            file_id=file_obj.file_id,
-                                            file_size=getattr(file_obj, 'file_size', 0),
-                                            mime_type=getattr(file_obj, 'mime_type', 'application/octet-stream')
-                                        )
-                                        
-                                        db.session.add(file_metadata)
-                                        db.session.commit()
-                                        
-                                        # Send confirmation
-                                        size_mb = round(file_metadata.file_size / (1024 * 1024), 2) if file_metadata.file_size > 0 else 0
-                                        import asyncio
-                                        loop = asyncio.new_event_loop()
-                                        asyncio.set_event_loop(loop)
-                                        try:
-                                            loop.run_until_complete(bot.send_message(
-                                                chat_id=user_id,
-                                                text=f"✅ **File Uploaded Successfully!**\n\n"
-                                                     f"📄 **Name**: {filename}\n"
-                                                     f"📊 **Size**: {size_mb} MB\n"
-                                                     f"🕒 **Stored**: {file_metadata.upload_date.strftime('%Y-%m-%d %H:%M')}\n\n"
-                                                     f"Use /myfiles to view all your files! 📁",
-                                                parse_mode='Markdown'
-                                            ))
-                                        finally:
-                                            loop.close()
-                            
-                            elif update.callback_query and update.callback_query.id:
-                                # Handle callback queries if needed
-                                import asyncio
-                                loop = asyncio.new_event_loop()
-                                asyncio.set_event_loop(loop)
-                                try:
-                                    loop.run_until_complete(bot.answer_callback_query(callback_query_id=update.callback_query.id))
-                                finally:
-                                    loop.close()
-                            
-                            logger.info(f"Successfully processed update: {update.update_id}")
-                            
-                        except Exception as proc_error:
-                            logger.error(f"Error processing update: {proc_error}", exc_info=True)
-                            # Send error message to user
-                            if update.message and update.message.from_user:
-                                try:
-                                    import asyncio
-                                    loop = asyncio.new_event_loop()
-                                    asyncio.set_event_loop(loop)
-                                    try:
-                                        loop.run_until_complete(bot.send_message(
-                                            chat_id=update.message.from_user.id,
-                                            text="❌ Sorry, something went wrong. Please try again."
-                                        ))
-                                    finally:
-                                        loop.close()
-                                except:
-                                    pass
-                    
-                    return 'OK'
-                    
-                except Exception as e:
-                    logger.error(f"Webhook error: {e}", exc_info=True)
-                    return 'Error', 500
-            
-            # Set up webhook URL automatically
-            try:
-                # Get the service URL from Render environment
-                service_url = os.environ.get("RENDER_EXTERNAL_URL")
+            # Don't wait for processing so Telegram gets its 200 right away
+            loop.call_soon_threadsafe(application.update_queue.put_nowait, update)
+            return 'OK', 200
+        
+        # Set up webhook URL automatically
+        try:
+            # Use an explicit webhook URL if given, otherwise build one from the Render service URL
+            webhook_url = os.environ.get("WEBHOOK_URL")
+            if not webhook_url:
+                service_url = RENDER_URL
                 if not service_url:
                     # Fallback - construct from common Render pattern
                     service_name = os.environ.get("RENDER_SERVICE_NAME", "telegram-file-bot")
                     service_url = f"https://{service_name}.onrender.com"
-                
-                webhook_url = f"{service_url}/webhook/{bot_token}"
+                webhook_url = f"{service_url}/webhook/{BOT_TOKEN}"
+            
+            # Every gunicorn worker runs this at boot; only the first to see a stale URL sets it
+            webhook_info = asyncio.run_coroutine_threadsafe(
+                application.bot.get_webhook_info(), loop
+            ).result(timeout=STARTUP_TIMEOUT)
+            if webhook_info.url == webhook_url:
+                logger.info("Webhook already set")
+            else:
                 logger.info(f"Setting webhook URL: {webhook_url}")
-                
-                # Set webhook using synchronous approach for startup
-                import requests
-                webhook_response = requests.post(
-                    f"https://api.telegram.org/bot{bot_token}/setWebhook",
-                    json={"url": webhook_url}
-                )
-                if webhook_response.status_code == 200:
+                try:
+                    # Reuse the Application's bot and connection pool rather than a one-off request
+                    asyncio.run_coroutine_threadsafe(
+                        application.bot.set_webhook(url=webhook_url), loop
+                    ).result(timeout=STARTUP_TIMEOUT)
                     logger.info("Webhook set successfully")
-                else:
-                    logger.error(f"Failed to set webhook: {webhook_response.text}")
-                    
-            except Exception as e:
-                logger.error(f"Error setting webhook: {e}")
+                except RetryAfter as e:
+                    # Another worker set it moments ago and Telegram is rate limiting the repeat
+                    logger.warning(f"Webhook update rate limited, assuming another worker set it: {e}")
             
-            logger.info("Bot configured for webhook mode")
+        except Exception as e:
+            logger.error(f"Error setting webhook: {e}")
         
-        # Run Flask app (this opens the required port for Render)
-        logger.info("Starting Flask app...")
+        logger.info("Bot configured for webhook mode")
+
+
+# On Render, configure webhook mode at import so gunicorn workers serve it
+if RENDER:
+    logger.info("Running on Render - Flask app with webhook mode")
+    setup_render_webhook()
+
+
+if __name__ == "__main__":
+    # Check if we're running on Render (production)
+    if RENDER:
+        # Production is served by gunicorn (see Procfile / render.yaml); this is only a fallback
+        logger.warning("Starting Flask development server on Render - use gunicorn in production")
         run_flask()
     else:
         # Local development - run both
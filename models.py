@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Integer, String, BigInteger, DateTime, Text
+from sqlalchemy import Integer, String, BigInteger, DateTime, Text, Index
 from sqlalchemy.orm import Mapped, mapped_column
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
@@ -17,7 +17,7 @@ class FileMetadata(db.Model):
     __tablename__ = 'file_metadata'
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    user_id: Mapped[int] = mapped_column(BigInteger, nullable=False, index=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
     file_id: Mapped[str] = mapped_column(String(255), nullable=False, unique=True)
     filename: Mapped[str] = mapped_column(String(500), nullable=False)
     file_size: Mapped[int] = mapped_column(BigInteger, nullable=True)
@@ -38,3 +38,16 @@ class FileMetadata(db.Model):
             'mime_type': self.mime_type,
             'upload_date': self.upload_date.isoformat() if self.upload_date else None
         }
+
+
+# Serves /myfiles: a user's files newest first, so LIMIT queries stop after one page.
+# Its leading user_id column also covers plain user_id lookups; databases created before
+# this index still carry the old single-column one and can drop it with
+# DROP INDEX IF EXISTS ix_file_metadata_user_id;
+# Built CONCURRENTLY on Postgres so adding it to a live table doesn't block uploads.
+file_user_date_index = Index(
+    'ix_file_user_date',
+    FileMetadata.user_id,
+    FileMetadata.upload_date.desc(),
+    postgresql_concurrently=True
+)